@@ -1,23 +1,35 @@
 # app.py
 import os
+import asyncio
+import hashlib
 from pathlib import Path
-from typing import List, Optional
+from typing import List, Literal, Optional
 import logging
+import time
+from contextlib import asynccontextmanager
 import requests
 
 from dotenv import load_dotenv
 from datetime import datetime, timezone
-from threading import Lock
+import orjson
+from cachetools import TTLCache
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Histogram, generate_latest
 from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse, PlainTextResponse
-from pydantic import BaseModel
-from google import genai
+from fastapi.responses import ORJSONResponse, PlainTextResponse, Response, StreamingResponse
+from pydantic import BaseModel, ConfigDict, TypeAdapter, field_validator
 from google.genai import errors as genai_errors
-from openai import OpenAI
-
-from rag_backend import get_hr_policy, build_sources_markdown
+from google.genai import types as genai_types
+
+from rag_backend import (
+    client,
+    openai_client,
+    http_client,
+    get_hr_policy_batch,
+    build_context,
+    build_sources_markdown,
+)
 
 # Setup logging
 logging.basicConfig(level=logging.INFO)
@@ -25,19 +37,290 @@ logger = logging.getLogger(__name__)
 
 load_dotenv()
 
-GEMINI_API_KEY = os.environ["GEMINI_API_KEY"]
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 SYSTEM_PROMPT_PATH = os.getenv("SYSTEM_PROMPT_PATH", "system_prompt.txt")
 # SYSTEM_PROMPT_PATH = os.getenv("SYSTEM_PROMPT_PATH", "../system_prompt.txt")
 
 MODEL_ID = "gemini-2.0-flash"  # any chat-capable Gemini model you have access to 
 OPENAI_MODEL = "gpt-5.2-chat-latest"  # OpenAI fallback model
+OPENAI_ROLES = {"model": "assistant"}  # Gemini role names that differ in OpenAI
+FALLBACK_ANSWER = "I'm sorry, I can't answer that. Please contact HR"
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "10000"))
+ANSWER_CACHE_TTL = int(os.getenv("ANSWER_CACHE_TTL", "3600"))
 SYSTEM_PROMPT = Path(SYSTEM_PROMPT_PATH).read_text(encoding="utf-8")
+# Chat UI shell, served from memory with a content-hash ETag
+INDEX_HTML = Path("static/index.html").read_bytes()
+INDEX_ETAG = '"' + hashlib.md5(INDEX_HTML).hexdigest() + '"'
+INDEX_HEADERS = {"ETag": INDEX_ETAG, "Cache-Control": "public, max-age=300"}
+SOURCE_DATA_HEADER = "### Source data from get_hr_policy:\n"
+# Fixed part of every prompt, built once instead of per request
+SYSTEM_PREFIX = SYSTEM_PROMPT + "\n\n" + SOURCE_DATA_HEADER
+PROMPT_CACHE_TTL = int(os.getenv("PROMPT_CACHE_TTL", "3600"))
+PROMPT_CACHE_RETRY = 300  # seconds to wait before retrying a failed cache create/refresh
+GEMINI_HEDGE_DELAY_MS = int(os.getenv("GEMINI_HEDGE_DELAY_MS", "2500"))
+GEMINI_BREAKER_FAILS = int(os.getenv("GEMINI_BREAKER_FAILS", "3"))
+GEMINI_BREAKER_RESET_S = int(os.getenv("GEMINI_BREAKER_RESET_S", "30"))
+RETRIEVAL_MAX_BATCH = int(os.getenv("RETRIEVAL_MAX_BATCH", "8"))
+RETRIEVAL_BATCH_TIMEOUT_MS = int(os.getenv("RETRIEVAL_BATCH_TIMEOUT_MS", "10"))
+
+
+class CircuitBreaker:
+    """Trip after fail_max consecutive failures and stay open for reset_timeout seconds.
+
+    Once the timeout passes, calls are let through again; one success closes
+    the breaker, another failure re-opens it.
+    """
+
+    def __init__(self, fail_max: int, reset_timeout: float):
+        self.fail_max = fail_max
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+
+    @property
+    def is_open(self) -> bool:
+        if self.opened_at is None:
+            return False
+        return time.monotonic() - self.opened_at < self.reset_timeout
+
+    def record_success(self) -> None:
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self.failures >= self.fail_max:
+            if self.opened_at is None or not self.is_open:
+                logger.warning("Gemini circuit breaker open, routing to OpenAI")
+            self.opened_at = time.monotonic()
+
+
+gemini_breaker = CircuitBreaker(GEMINI_BREAKER_FAILS, GEMINI_BREAKER_RESET_S)
+
+
+def is_gemini_outage(error: Exception) -> bool:
+    """True for errors that say Gemini is unhealthy: transport errors, timeouts, 429 and 5xx.
+
+    Other 4xx errors are caused by the request itself and must not trip the
+    breaker for everyone.
+    """
+    return not (isinstance(error, genai_errors.ClientError) and error.code != 429)
+
+
+def is_query_error(error: Exception) -> bool:
+    """True if an upstream rejected the request itself (HTTP 400), which may be down to a single query.
+
+    Gemini errors carry the status as .code, OpenAI's as .status_code and
+    Pinecone's as .status; transport errors have none.
+    """
+    for attr in ("code", "status_code", "status"):
+        status = getattr(error, attr, None)
+        if isinstance(status, int):
+            return status == 400
+    return False
+
+
+class RetrievalBatcher:
+    """Coalesce concurrent retrievals into one embedding call.
+
+    Queries wait on a queue until max_batch are pending or timeout_ms has
+    passed since the first one; the whole batch is then embedded in a single
+    Gemini call and its Pinecone queries run concurrently.
+    """
+
+    def __init__(self, top_k: int, max_batch: int, timeout_ms: int):
+        self.top_k = top_k
+        self.max_batch = max_batch
+        self.timeout = timeout_ms / 1000
+        self.queue: Optional[asyncio.Queue] = None
+        self.worker: Optional[asyncio.Task] = None
+        self.in_flight = set()
+
+    def start(self) -> None:
+        self.queue = asyncio.Queue()
+        self.worker = asyncio.create_task(self._collect())
+
+    async def stop(self) -> None:
+        if self.worker:
+            self.worker.cancel()
+            await asyncio.gather(self.worker, *self.in_flight, return_exceptions=True)
+        self.worker = None
+
+    async def submit(self, query: str) -> list:
+        if not query.strip():
+            # Fail just this caller instead of poisoning a shared batch
+            raise ValueError("query must not be empty")
+        if self.worker is None or self.max_batch <= 1:
+            # Not running inside the app lifespan (or batching disabled)
+            return (await get_hr_policy_batch([query], top_k=self.top_k))[0]
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((query, future))
+        return await future
+
+    async def _collect(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.timeout
+            while len(batch) < self.max_batch:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+            # Dispatch without blocking collection of the next batch
+            task = asyncio.create_task(self._dispatch(batch))
+            self.in_flight.add(task)
+            task.add_done_callback(self.in_flight.discard)
+
+    async def _dispatch(self, batch: list) -> None:
+        queries = [query for query, _ in batch]
+        try:
+            results = await get_hr_policy_batch(queries, top_k=self.top_k)
+        except Exception as e:
+            if len(batch) == 1 or not is_query_error(e):
+                # Rate limits, 5xx and transport errors hit every query alike;
+                # retrying one by one would only multiply load on a struggling upstream
+                results = [e] * len(batch)
+            else:
+                # A 400 may come from one bad query; retry each on its own
+                retried = await asyncio.gather(
+                    *(get_hr_policy_batch([query], top_k=self.top_k) for query in queries),
+                    return_exceptions=True,
+                )
+                results = [r if isinstance(r, BaseException) else r[0] for r in retried]
+        for (_, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, BaseException):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+
+retrieval_batcher = RetrievalBatcher(top_k=3, max_batch=RETRIEVAL_MAX_BATCH, timeout_ms=RETRIEVAL_BATCH_TIMEOUT_MS)
+
+
+class PromptCacheKeeper:
+    """Keep SYSTEM_PROMPT in a Gemini cached-content so it isn't re-sent (and re-prefilled) per request.
+
+    A background task creates the cache once and then extends its TTL halfway
+    through each period; requests only read `name` and never wait on it. When
+    Gemini rejects the create as invalid (e.g. the prompt is below the model's
+    minimum cacheable size) caching is given up for good and the system
+    prompt is sent inline.
+    """
+
+    def __init__(self, ttl: int, retry: int):
+        self.ttl = ttl
+        self.retry = min(retry, ttl / 2)
+        self.name: Optional[str] = None
+        self.stale: Optional[str] = None
+        self.wake: Optional[asyncio.Event] = None
+        self.worker: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        if self.ttl <= 0:
+            return
+        self.wake = asyncio.Event()
+        self.worker = asyncio.create_task(self._maintain())
+
+    async def stop(self) -> None:
+        if self.worker:
+            self.worker.cancel()
+            await asyncio.gather(self.worker, return_exceptions=True)
+        self.worker = None
+        # Don't leave a billed cache behind until its TTL runs out
+        for name in (self.stale, self.name):
+            if name:
+                await self._delete(name)
+        self.name = self.stale = None
+
+    def invalidate(self, name: str, error: Exception) -> None:
+        """Drop name if Gemini says it is gone or forbidden; the worker recreates it.
+
+        Other errors (429, 5xx, transport) say nothing about the cache.
+        """
+        if not (isinstance(error, genai_errors.ClientError) and error.code in (403, 404)):
+            return
+        if name == self.name:
+            self.name = None
+            self.stale = name
+            if self.wake:
+                self.wake.set()
+
+    async def _delete(self, name: str) -> None:
+        try:
+            await client.aio.caches.delete(name=name)
+        except Exception as e:
+            logger.warning(f"Could not delete Gemini prompt cache {name}: {e}")
+
+    async def _maintain(self) -> None:
+        ttl = f"{self.ttl}s"
+        while True:
+            self.wake.clear()
+            if self.stale:
+                # Delete the old cache before replacing it so it doesn't stay billed
+                stale, self.stale = self.stale, None
+                await self._delete(stale)
+            name = self.name
+            delay = self.ttl / 2
+            try:
+                if name:
+                    await client.aio.caches.update(
+                        name=name,
+                        config=genai_types.UpdateCachedContentConfig(ttl=ttl),
+                    )
+                else:
+                    cache = await client.aio.caches.create(
+                        model=MODEL_ID,
+                        config=genai_types.CreateCachedContentConfig(
+                            system_instruction=SYSTEM_PROMPT,
+                            ttl=ttl,
+                        ),
+                    )
+                    self.name = cache.name
+                    logger.info(f"Created Gemini prompt cache {cache.name}")
+            except genai_errors.ClientError as e:
+                if name and e.code in (403, 404):
+                    self.invalidate(name, e)
+                    continue
+                if not name and e.code == 400:
+                    # INVALID_ARGUMENT, e.g. "cached content is too small": retrying won't help
+                    logger.info(f"Gemini prompt cache not supported, sending system prompt inline: {e}")
+                    return
+                logger.warning(f"Gemini prompt cache refresh failed, retrying in {self.retry:g}s: {e}")
+                delay = self.retry
+            except Exception as e:
+                logger.warning(f"Gemini prompt cache refresh failed, retrying in {self.retry:g}s: {e}")
+                delay = self.retry
+            try:
+                await asyncio.wait_for(self.wake.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
 
-client = genai.Client(api_key=GEMINI_API_KEY)
-openai_client = OpenAI(api_key=OPENAI_API_KEY) if OPENAI_API_KEY else None
+prompt_cache_keeper = PromptCacheKeeper(ttl=PROMPT_CACHE_TTL, retry=PROMPT_CACHE_RETRY)
 
-app = FastAPI(title="HR Policy Assistant API")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Prompt cache is created in the background; requests send the prompt inline until it's ready
+    prompt_cache_keeper.start()
+    retrieval_batcher.start()
+    yield
+    await retrieval_batcher.stop()
+    await prompt_cache_keeper.stop()
+    # Release pooled keep-alive connections on shutdown
+    await http_client.aclose()
+
+
+app = FastAPI(
+    title="HR Policy Assistant API",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse,
+)
 
 app.add_middleware(
     CORSMiddleware,
@@ -58,8 +341,8 @@ async def skip_health_logs(request: Request, call_next):
 # Mount static files
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
-# Simple in-memory metrics
-_metrics_lock = Lock()
+# Simple in-memory metrics. All handlers run on the event loop thread and
+# never await mid-update, so the counters need no lock.
 METRICS = {
     "start_time": datetime.now(timezone.utc).isoformat(),
     "requests": 0,
@@ -69,17 +352,63 @@ METRICS = {
     "prompt_tokens": 0,
     "completion_tokens": 0,
     "total_tokens": 0,
+    "cache_hits": 0,
+    "cache_misses": 0,
+}
+
+# Prometheus twins of the METRICS counters (exported at /metrics.prom)
+PROM_COUNTERS = {
+    "requests": Counter("hr_rag_requests", "Chat requests received"),
+    "errors": Counter("hr_rag_errors", "Chat requests answered with the error fallback"),
+    "gemini_calls": Counter("hr_rag_gemini_calls", "Successful Gemini generations"),
+    "openai_calls": Counter("hr_rag_openai_calls", "Successful OpenAI generations"),
+    "prompt_tokens": Counter("hr_rag_prompt_tokens", "Prompt tokens used"),
+    "completion_tokens": Counter("hr_rag_completion_tokens", "Completion tokens used"),
+    "total_tokens": Counter("hr_rag_tokens", "Total tokens used"),
+    "cache_hits": Counter("hr_rag_cache_hits", "Answer cache hits"),
+    "cache_misses": Counter("hr_rag_cache_misses", "Answer cache misses"),
 }
+CHAT_LATENCY = Histogram("hr_rag_chat_latency_seconds", "End-to-end /chat latency")
+
+
+def count(name: str, value: int = 1) -> None:
+    """Bump a counter in METRICS and in Prometheus."""
+    METRICS[name] += value
+    PROM_COUNTERS[name].inc(value)
+
+# Exact-match answer cache keyed by a SHA-256 of the request (raw prompts are never stored)
+_answer_cache_lock = asyncio.Lock()
+_answer_cache = TTLCache(maxsize=ANSWER_CACHE_SIZE, ttl=ANSWER_CACHE_TTL) if ANSWER_CACHE_SIZE > 0 else None
+
+
+# Immutable request/response models; unknown fields are rejected up front
+MODEL_CONFIG = ConfigDict(extra="forbid", frozen=True)
 
 
 class Message(BaseModel):
-    role: str  # "user" or "model"
+    model_config = MODEL_CONFIG
+
+    role: Literal["user", "model"]
     content: str
 
 
+# Built once; serializes history straight to JSON bytes for cache keys
+MESSAGE_LIST_ADAPTER = TypeAdapter(List[Message])
+
+
 class ChatRequest(BaseModel):
+    model_config = MODEL_CONFIG
+
     message: str
     history: List[Message] = []
+
+    @field_validator("message")
+    @classmethod
+    def message_not_blank(cls, value: str) -> str:
+        """Reject empty/whitespace messages before they reach retrieval"""
+        if not value.strip():
+            raise ValueError("message must not be empty")
+        return value
     
     @property
     def validated_message(self):
@@ -88,13 +417,28 @@ class ChatRequest(BaseModel):
 
 
 class ChatResponse(BaseModel):
+    model_config = MODEL_CONFIG
+
     reply: str
 
 
+def answer_cache_key(message: str, history: List[Message]) -> str:
+    """Hash the message plus history so identical requests share one cache entry."""
+    payload = message.encode("utf-8") + b"|" + MESSAGE_LIST_ADAPTER.dump_json(history)
+    return hashlib.sha256(payload).hexdigest()
+
+
+def cache_hit_rate(snapshot: dict) -> float:
+    lookups = snapshot["cache_hits"] + snapshot["cache_misses"]
+    return round(snapshot["cache_hits"] / lookups, 4) if lookups else 0.0
+
+
 @app.get("/")
-def root():
+async def root(request: Request):
     """Serve the chat interface"""
-    return FileResponse("static/index.html")
+    if request.headers.get("if-none-match") == INDEX_ETAG:
+        return Response(status_code=304, headers=INDEX_HEADERS)
+    return Response(content=INDEX_HTML, media_type="text/html", headers=INDEX_HEADERS)
 
 
 @app.get("/health")
@@ -104,31 +448,31 @@ def health():
 
 
 @app.get("/metrics")
-def metrics():
+async def metrics():
     """Return simple runtime metrics for usage tracking"""
-    with _metrics_lock:
-        return METRICS.copy()
+    snapshot = METRICS.copy()
+    snapshot["cache_hit_rate"] = cache_hit_rate(snapshot)
+    return snapshot
 
 
 @app.get("/metrics.json")
-def metrics_json():
+async def metrics_json():
     """Human-readable JSON metrics with uptime."""
-    with _metrics_lock:
-        snapshot = METRICS.copy()
+    snapshot = METRICS.copy()
     try:
         start_dt = datetime.fromisoformat(snapshot["start_time"])
     except Exception:
         start_dt = datetime.now(timezone.utc)
     uptime = (datetime.now(timezone.utc) - start_dt).total_seconds()
     snapshot["uptime_seconds"] = int(uptime)
+    snapshot["cache_hit_rate"] = cache_hit_rate(snapshot)
     return snapshot
 
 
 @app.get("/metrics.txt")
-def metrics_text():
+async def metrics_text():
     """Plain-text human-friendly metrics with uptime."""
-    with _metrics_lock:
-        snapshot = METRICS.copy()
+    snapshot = METRICS.copy()
     try:
         start_dt = datetime.fromisoformat(snapshot["start_time"])
     except Exception:
@@ -144,139 +488,347 @@ def metrics_text():
         f"prompt_tokens: {snapshot['prompt_tokens']}",
         f"completion_tokens: {snapshot['completion_tokens']}",
         f"total_tokens: {snapshot['total_tokens']}",
+        f"cache_hits: {snapshot['cache_hits']}",
+        f"cache_misses: {snapshot['cache_misses']}",
+        f"cache_hit_rate: {cache_hit_rate(snapshot)}",
     ]
     body = "\n".join(lines) + "\n"
     return PlainTextResponse(content=body)
 
 
+@app.get("/metrics.prom")
+async def metrics_prometheus():
+    """Prometheus exposition format, for scrapers."""
+    return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
 @app.post("/metrics/reset")
-def metrics_reset(key: Optional[str] = None):
+async def metrics_reset(key: Optional[str] = None):
     """Reset counters; require `METRICS_RESET_KEY` if configured."""
     expected = os.getenv("METRICS_RESET_KEY")
     if expected:
         if not key or key != expected:
             raise HTTPException(status_code=403, detail="Forbidden")
     now = datetime.now(timezone.utc).isoformat()
-    with _metrics_lock:
-        METRICS.update({
-            "start_time": now,
-            "requests": 0,
-            "errors": 0,
-            "gemini_calls": 0,
-            "openai_calls": 0,
-            "prompt_tokens": 0,
-            "completion_tokens": 0,
-            "total_tokens": 0,
-        })
+    # Prometheus counters are monotonic by design and are not reset
+    METRICS.update({
+        "start_time": now,
+        "requests": 0,
+        "errors": 0,
+        "gemini_calls": 0,
+        "openai_calls": 0,
+        "prompt_tokens": 0,
+        "completion_tokens": 0,
+        "total_tokens": 0,
+        "cache_hits": 0,
+        "cache_misses": 0,
+    })
     return {"status": "reset", "start_time": now}
 
 
-@app.post("/chat", response_model=ChatResponse)
-def chat(req: ChatRequest):
-    # Input validation: limit to 200 chars to control tokens
-    message = req.validated_message
-    with _metrics_lock:
-        METRICS["requests"] += 1
-    
-    # 1) Call the "get_hr_policy tool" – same as n8n agent would do
-    docs = get_hr_policy(message, top_k=3)
-    sources_md = build_sources_markdown(docs)
+def gemini_config(prompt_cache: Optional[str]) -> Optional[genai_types.GenerateContentConfig]:
+    if not prompt_cache:
+        return None
+    return genai_types.GenerateContentConfig(cached_content=prompt_cache)
 
-    # Concatenate retrieved snippets - limit to 2000 chars for token control
-    context = "\n\n".join(f"- {d['text']}" for d in docs)[:2000]
 
-    # 2) Build instruction that includes:
-    #    - the original system prompt from system_prompt.txt
-    #    - the current retrieved snippets (“source data”)
-    system_and_context = (
-        SYSTEM_PROMPT
-        + "\n\n### Source data from get_hr_policy:\n"
-        + context
-    )
-
-    # 3) Convert into Gemini-style contents
-    contents = [{"role": "user", "parts": [{"text": system_and_context}]}]
-    for m in req.history:
-        contents.append({"role": m.role, "parts": [{"text": m.content}]})
-    contents.append({"role": "user", "parts": [{"text": message}]})
+async def record_gemini_usage(usage) -> None:
+    """Add Gemini token usage to METRICS; usage metadata may be missing."""
+    try:
+        prompt_t = getattr(usage, "prompt_token_count", 0) if usage else 0
+        completion_t = getattr(usage, "candidates_token_count", 0) if usage else 0
+        total_t = getattr(usage, "total_token_count", 0) if usage else (prompt_t + completion_t)
+        count("gemini_calls")
+        count("prompt_tokens", int(prompt_t or 0))
+        count("completion_tokens", int(completion_t or 0))
+        count("total_tokens", int(total_t or 0))
+        logger.info(f"Gemini tokens: prompt={prompt_t}, completion={completion_t}, total={total_t}")
+    except Exception as _:
+        # Non-fatal if usage not available
+        pass
+
+
+async def openai_answer(system_and_context: str, history: List[Message], message: str) -> str:
+    """Fallback to OpenAI on Gemini errors when available.
+
+    Returns FALLBACK_ANSWER on failure; callers decide whether that counts as
+    an error (a losing hedge that fails is not one).
+    """
+    if not openai_client:
+        # No OpenAI configured
+        logger.warning("OpenAI client not configured, using fallback")
+        return FALLBACK_ANSWER
 
-    answer = None
-    
-    # Try Gemini first
     try:
-        result = client.models.generate_content(
+        # Convert history to OpenAI format
+        openai_messages = [
+            {"role": "system", "content": system_and_context},
+            *[
+                {"role": OPENAI_ROLES.get(m.role, m.role), "content": m.content}
+                for m in history
+            ],
+            {"role": "user", "content": message},
+        ]
+
+        # Call OpenAI with gpt-5.2-chat-latest
+        response = await openai_client.chat.completions.create(
+            model=OPENAI_MODEL,
+            messages=openai_messages,
+            max_completion_tokens=400,
+        )
+        answer = response.choices[0].message.content.strip()
+        # Collect OpenAI usage
+        try:
+            usage = getattr(response, "usage", None)
+            prompt_t = getattr(usage, "prompt_tokens", None)
+            completion_t = getattr(usage, "completion_tokens", None)
+            total_t = getattr(usage, "total_tokens", None)
+            count("openai_calls")
+            count("prompt_tokens", int(prompt_t or 0))
+            count("completion_tokens", int(completion_t or 0))
+            count("total_tokens", int(total_t or 0))
+            logger.info(f"OpenAI tokens: prompt={prompt_t}, completion={completion_t}, total={total_t}")
+        except Exception:
+            count("openai_calls")
+        return answer
+    except Exception as oe:
+        # Log OpenAI error
+        logger.error(f"OpenAI error: {oe}")
+        return FALLBACK_ANSWER
+
+
+async def gemini_answer(contents: list, prompt_cache: Optional[str]) -> Optional[str]:
+    """Ask Gemini for an answer; returns None on Gemini errors."""
+    try:
+        result = await client.aio.models.generate_content(
             model=MODEL_ID,
             contents=contents,
+            config=gemini_config(prompt_cache),
         )
-        answer = result.text.strip()
-        # Collect Gemini usage if available
-        try:
-            usage = getattr(result, "usage_metadata", None)
-            prompt_t = getattr(usage, "prompt_token_count", 0) if usage else 0
-            completion_t = getattr(usage, "candidates_token_count", 0) if usage else 0
-            total_t = getattr(usage, "total_token_count", 0) if usage else (prompt_t + completion_t)
-            with _metrics_lock:
-                METRICS["gemini_calls"] += 1
-                METRICS["prompt_tokens"] += int(prompt_t or 0)
-                METRICS["completion_tokens"] += int(completion_t or 0)
-                METRICS["total_tokens"] += int(total_t or 0)
-            logger.info(f"Gemini tokens: prompt={prompt_t}, completion={completion_t}, total={total_t}")
-        except Exception as _:
-            # Non-fatal if usage not available
-            pass
-    except genai_errors.ClientError as e:
+    except Exception as e:
         # Log Gemini error
         logger.error(f"Gemini error: {e}")
-        # Fallback to OpenAI on Gemini errors when available
+        if is_gemini_outage(e):
+            gemini_breaker.record_failure()
+        if prompt_cache:
+            # Recreate the cache only if Gemini reports it gone or forbidden
+            prompt_cache_keeper.invalidate(prompt_cache, e)
+        return None
+    gemini_breaker.record_success()
+    await record_gemini_usage(getattr(result, "usage_metadata", None))
+    return result.text.strip()
+
+
+async def generate_answer(
+    contents: list,
+    prompt_cache: Optional[str],
+    system_and_context: str,
+    history: List[Message],
+    message: str,
+) -> str:
+    """Ask Gemini for an answer, hedging with OpenAI when Gemini is slow or failing.
+
+    Gemini gets GEMINI_HEDGE_DELAY_MS to answer on its own; after that an
+    OpenAI request is raced against it and the first usable answer wins.
+    While the circuit breaker is open Gemini is skipped entirely.
+    """
+    if openai_client and gemini_breaker.is_open:
+        answer = await openai_answer(system_and_context, history, message)
+    else:
+        answer = await hedged_answer(contents, prompt_cache, system_and_context, history, message)
+    # Only an answer the user actually gets as the fallback is an error
+    if answer == FALLBACK_ANSWER:
+        count("errors")
+    return answer
+
+
+async def hedged_answer(
+    contents: list,
+    prompt_cache: Optional[str],
+    system_and_context: str,
+    history: List[Message],
+    message: str,
+) -> str:
+    """Race Gemini against a delayed OpenAI request; see generate_answer."""
+
+    gemini_task = asyncio.create_task(gemini_answer(contents, prompt_cache))
+    pending = {gemini_task}
+    try:
         if openai_client:
-            try:
-                # Convert history to OpenAI format
-                openai_messages = [
-                    {"role": "system", "content": system_and_context}
-                ]
-                for m in req.history:
-                    openai_messages.append({
-                        "role": "assistant" if m.role == "model" else m.role,
-                        "content": m.content
-                    })
-                openai_messages.append({"role": "user", "content": message})
-                
-                # Call OpenAI with gpt-5.2-chat-latest
-                response = openai_client.chat.completions.create(
-                    model=OPENAI_MODEL,
-                    messages=openai_messages,
-                    max_completion_tokens=400,
-                )
-                answer = response.choices[0].message.content.strip()
-                # Collect OpenAI usage
-                try:
-                    usage = getattr(response, "usage", None)
-                    prompt_t = getattr(usage, "prompt_tokens", None)
-                    completion_t = getattr(usage, "completion_tokens", None)
-                    total_t = getattr(usage, "total_tokens", None)
-                    with _metrics_lock:
-                        METRICS["openai_calls"] += 1
-                        METRICS["prompt_tokens"] += int(prompt_t or 0)
-                        METRICS["completion_tokens"] += int(completion_t or 0)
-                        METRICS["total_tokens"] += int(total_t or 0)
-                    logger.info(f"OpenAI tokens: prompt={prompt_t}, completion={completion_t}, total={total_t}")
-                except Exception:
-                    with _metrics_lock:
-                        METRICS["openai_calls"] += 1
-            except Exception as oe:
-                # Log OpenAI error
-                logger.error(f"OpenAI error: {oe}")
-                with _metrics_lock:
-                    METRICS["errors"] += 1
-                answer = "I'm sorry, I can't answer that. Please contact HR"
+            # Gemini gets a head start before OpenAI is raced against it
+            await asyncio.wait(pending, timeout=GEMINI_HEDGE_DELAY_MS / 1000)
         else:
-            # No OpenAI configured
-            logger.warning("OpenAI client not configured, using fallback")
-            with _metrics_lock:
-                METRICS["errors"] += 1
-            answer = "I'm sorry, I can't answer that. Please contact HR"
+            await gemini_task
+        if gemini_task.done():
+            pending = set()
+            answer = gemini_task.result()
+            return answer if answer is not None else await openai_answer(system_and_context, history, message)
+
+        # Gemini is slow: race it against OpenAI and keep whichever answers first
+        openai_task = asyncio.create_task(openai_answer(system_and_context, history, message))
+        pending = {gemini_task, openai_task}
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                answer = task.result()
+                if answer is not None and answer != FALLBACK_ANSWER:
+                    if task is openai_task and gemini_task in pending:
+                        # Losing the race counts against Gemini too
+                        gemini_breaker.record_failure()
+                    return answer
+        return FALLBACK_ANSWER
+    finally:
+        # Never leave the losing (or an abandoned) request running
+        for task in pending:
+            task.cancel()
+
+
+async def lookup_cached_answer(cache_key: str) -> Optional[tuple]:
+    """Return the cached (answer, sources_md) pair for this request, if any."""
+    if _answer_cache is None:
+        return None
+    async with _answer_cache_lock:
+        cached = _answer_cache.get(cache_key)
+    count("cache_hits" if cached is not None else "cache_misses")
+    return cached
+
+
+async def store_cached_answer(cache_key: str, answer: str, sources_md: str) -> None:
+    # Don't pin error fallbacks in the cache
+    if _answer_cache is not None and answer != FALLBACK_ANSWER:
+        async with _answer_cache_lock:
+            _answer_cache[cache_key] = (answer, sources_md)
+
+
+async def retrieve_and_build_contents(message: str, history: List[Message], prompt_cache: Optional[str]):
+    """Run retrieval and build the prompt; returns (docs, system_and_context, contents).
+
+    system_and_context always carries the full system prompt (OpenAI needs
+    it); the Gemini contents leave it out when it lives in prompt_cache.
+    """
+    # 1) Call the "get_hr_policy tool" – same as n8n agent would do
+    #    (batched with concurrent requests; top_k=3 is set on the batcher)
+    docs = await retrieval_batcher.submit(message)
+
+    # Concatenate retrieved snippets - limit to 2000 chars for token control
+    context = build_context(docs, max_chars=2000)
+
+    # 2) Build instruction that includes:
+    #    - the original system prompt from system_prompt.txt
+    #    - the current retrieved snippets (“source data”)
+    system_and_context = SYSTEM_PREFIX + context
+
+    # 3) Convert into Gemini-style contents
+    first_turn = SOURCE_DATA_HEADER + context if prompt_cache else system_and_context
+    contents = [
+        {"role": "user", "parts": [{"text": first_turn}]},
+        *[{"role": m.role, "parts": [{"text": m.content}]} for m in history],
+        {"role": "user", "parts": [{"text": message}]},
+    ]
+    return docs, system_and_context, contents
+
+
+def sse_event(payload: dict) -> str:
+    return f"data: {orjson.dumps(payload).decode()}\n\n"
+
+
+@app.post("/chat", response_model=ChatResponse)
+async def chat(req: ChatRequest):
+    # Input validation: limit to 200 chars to control tokens
+    message = req.validated_message
+    count("requests")
+    started = time.perf_counter()
+
+    cache_key = answer_cache_key(message, req.history)
+    cached = await lookup_cached_answer(cache_key)
+    if cached is not None:
+        answer, sources_md = cached
+        CHAT_LATENCY.observe(time.perf_counter() - started)
+        return ChatResponse(reply=answer + "\n\n" + sources_md)
+
+    prompt_cache = prompt_cache_keeper.name
+    docs, system_and_context, contents = await retrieve_and_build_contents(message, req.history, prompt_cache)
+
+    # The footer only depends on docs; a plain join is cheaper inline than via a thread
+    sources_md = build_sources_markdown(docs)
+    answer = await generate_answer(contents, prompt_cache, system_and_context, req.history, message)
+    await store_cached_answer(cache_key, answer, sources_md)
 
     # 4) Append our own “Sources” footer (the prompt also asks for this style)
     answer_with_sources = answer + "\n\n" + sources_md
-
+    CHAT_LATENCY.observe(time.perf_counter() - started)
     return ChatResponse(reply=answer_with_sources)
+
+
+@app.post("/chat/stream")
+async def chat_stream(req: ChatRequest):
+    """Stream the answer as Server-Sent Events.
+
+    Each event is `data: {"delta": "..."}` with the next piece of the answer;
+    the last event is `data: {"sources": "..."}` with the sources footer, or
+    `data: {"error": "..."}` if Gemini fails mid-answer, in which case the
+    deltas so far are an incomplete answer and should be discarded.
+    """
+    message = req.validated_message
+    count("requests")
+
+    async def event_stream():
+        cache_key = answer_cache_key(message, req.history)
+        cached = await lookup_cached_answer(cache_key)
+        if cached is not None:
+            answer, sources_md = cached
+            yield sse_event({"delta": answer})
+            yield sse_event({"sources": sources_md})
+            return
+
+        prompt_cache = prompt_cache_keeper.name
+        docs, system_and_context, contents = await retrieve_and_build_contents(message, req.history, prompt_cache)
+        sources_md = build_sources_markdown(docs)
+
+        parts = []
+        answer = None
+        if not (openai_client and gemini_breaker.is_open):
+            try:
+                usage = None
+                stream = await client.aio.models.generate_content_stream(
+                    model=MODEL_ID,
+                    contents=contents,
+                    config=gemini_config(prompt_cache),
+                )
+                async for chunk in stream:
+                    usage = getattr(chunk, "usage_metadata", None) or usage
+                    if chunk.text:
+                        parts.append(chunk.text)
+                        yield sse_event({"delta": chunk.text})
+                gemini_breaker.record_success()
+                await record_gemini_usage(usage)
+                answer = "".join(parts).strip()
+            except Exception as e:
+                logger.error(f"Gemini error: {e}")
+                if is_gemini_outage(e):
+                    gemini_breaker.record_failure()
+                if prompt_cache:
+                    prompt_cache_keeper.invalidate(prompt_cache, e)
+                if parts:
+                    # Already streamed part of the answer; don't mix in a second model.
+                    # Tell the client the text so far is incomplete and end the stream.
+                    count("errors")
+                    yield sse_event({"error": FALLBACK_ANSWER})
+                    return
+
+        if answer is None:
+            # Gemini failed before streaming anything, or its breaker is open
+            answer = await openai_answer(system_and_context, req.history, message)
+            if answer == FALLBACK_ANSWER:
+                count("errors")
+            yield sse_event({"delta": answer})
+
+        await store_cached_answer(cache_key, answer, sources_md)
+        yield sse_event({"sources": sources_md})
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        # Stop proxies (e.g. Render's) from buffering the stream
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
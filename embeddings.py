@@ -0,0 +1,51 @@
+# embeddings.py
+# Text/vector processing shared by ingest and query: both sides must resize
+# and quantize identically or stored and query vectors won't match.
+import os
+from typing import List
+
+import numpy as np
+from dotenv import load_dotenv
+
+load_dotenv()
+
+TARGET_DIM = int(os.getenv("EMBED_DIM", "768"))
+EMBED_INT8 = os.getenv("EMBED_INT8", "false").lower() in ("1", "true", "yes")
+# Separators treated as sentence boundaries when chunking and trimming text
+SENTENCE_ENDS = (". ", "! ", "? ", "\n")
+
+
+def resize_vector(vec: List[float]) -> List[float]:
+    """Ensure dimension matches target"""
+    n = len(vec)
+    if n == TARGET_DIM:
+        return vec
+    # Downsample to match Pinecone index dim for demo
+    arr = np.asarray(vec, dtype=np.float32)
+    # Average-pool contiguous blocks when divisible
+    if n % TARGET_DIM == 0:
+        return arr.reshape(TARGET_DIM, -1).mean(axis=1).tolist()
+    # Fallback: stride sampling at indices int(i * n / TARGET_DIM)
+    return arr[np.arange(TARGET_DIM) * n // TARGET_DIM].tolist()
+
+
+def quantize_int8(vec: List[float]) -> List[float]:
+    """Round a vector onto the int8 grid [-127, 127] by max-abs scaling.
+
+    The index uses cosine similarity, which ignores vector scale, so the
+    integer codes are stored/queried as-is (as floats, which Pinecone
+    expects) and serialize to a few characters each instead of ~20.
+    """
+    arr = np.asarray(vec, dtype=np.float32)
+    max_abs = float(np.abs(arr).max()) if arr.size else 0.0
+    if max_abs == 0.0:
+        return list(vec)
+    return np.round(arr * (127 / max_abs)).tolist()
+
+
+def prepare_vectors(vecs: List[List[float]]) -> List[List[float]]:
+    """Resize raw embeddings to the index dim, then quantize if EMBED_INT8 is set."""
+    vecs = [resize_vector(vec) for vec in vecs]
+    if EMBED_INT8:
+        vecs = [quantize_int8(vec) for vec in vecs]
+    return vecs
@@ -1,9 +1,13 @@
 # ingest_hr_docs.py
 import sys
 import os
+import random
+import time
 import uuid
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from pathlib import Path
-from typing import List
+from typing import Iterator, List, Tuple
 
 from dotenv import load_dotenv
 from google import genai
@@ -11,6 +15,8 @@ from openai import OpenAI
 from pinecone import Pinecone, ServerlessSpec
 from pypdf import PdfReader
 
+from embeddings import SENTENCE_ENDS, prepare_vectors
+
 load_dotenv()
 
 GEMINI_API_KEY = os.environ["GEMINI_API_KEY"]
@@ -28,7 +34,10 @@ client = genai.Client(api_key=GEMINI_API_KEY)
 openai_client = OpenAI(api_key=OPENAI_API_KEY) if OPENAI_API_KEY else None
 pc = Pinecone(api_key=PINECONE_API_KEY)
 index = pc.Index(host=PINECONE_INDEX_HOST)  # host is your hr-… Pinecone endpoint
-TARGET_DIM = int(os.getenv("EMBED_DIM", "768"))
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "100"))
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "8"))
+UPSERT_BATCH_SIZE = 100  # Pinecone's recommended max vectors per upsert
+EMBED_RETRIES = 5  # attempts per batch when the embedding API returns 429
 
 
 def extract_text(path: Path) -> str:
@@ -40,104 +49,178 @@ def extract_text(path: Path) -> str:
         return path.read_text(encoding="utf-8", errors="ignore")
 
 
-def chunk_text(text: str, max_chars: int = 1200, overlap: int = 200) -> List[str]:
-    chunks = []
+def chunk_offsets(text: str, max_chars: int = 1200, overlap: int = 200) -> List[Tuple[int, int]]:
+    """Compute (start, end) offsets of overlapping chunks without slicing text."""
+    offsets = []
     start = 0
     n = len(text)
     while start < n:
         end = min(start + max_chars, n)
-        chunks.append(text[start:end])
+        if end < n:
+            # Prefer ending on a sentence boundary in the back half of the window
+            cut = max(text.rfind(sep, start + max_chars // 2, end) for sep in SENTENCE_ENDS)
+            if cut != -1:
+                end = cut + 1
+        offsets.append((start, end))
         if end == n:
             break  # avoid negative start when text length < overlap
-        start = max(end - overlap, start + 1)
-    return chunks
+        next_start = max(end - overlap, start + 1)
+        # Start the next chunk at a sentence boundary inside the overlap, not mid-word
+        hits = []
+        for sep in SENTENCE_ENDS:
+            pos = text.find(sep, next_start, end)
+            if pos != -1 and pos + len(sep) < end:
+                hits.append(pos + len(sep))
+        start = min(hits, default=next_start)
+    return offsets
+
 
+def chunk_text(text: str, max_chars: int = 1200, overlap: int = 200) -> Iterator[str]:
+    # Slice lazily so only the chunk being consumed is materialized
+    return (text[s:e] for s, e in chunk_offsets(text, max_chars, overlap))
 
-def embed(text: str) -> List[float]:
-    """Embed text using Gemini, with OpenAI fallback if quota exceeded."""
+
+def embed_batch(texts: List[str]) -> List[List[float]]:
+    """Embed a batch of texts in one call using Gemini, with OpenAI fallback if quota exceeded."""
     try:
         res = client.models.embed_content(
             model="gemini-embedding-001",
-            contents=text,
+            contents=texts,
         )
-        vec = res.embeddings[0].values
+        vecs = [e.values for e in res.embeddings]
     except Exception:
         # Fallback to OpenAI if Gemini fails and OpenAI is configured
         if openai_client:
             response = openai_client.embeddings.create(
                 model="text-embedding-3-small",
-                input=text
+                input=texts
             )
-            vec = response.data[0].embedding
+            vecs = [d.embedding for d in response.data]
         else:
             raise
-    
-    # Ensure dimension matches target
-    n = len(vec)
-    if n == TARGET_DIM:
-        return vec
-    # Downsample to match Pinecone index dim for demo
-    # Average-pool contiguous blocks when divisible
-    if n % TARGET_DIM == 0:
-        step = n // TARGET_DIM
-        return [sum(vec[i*step:(i+1)*step]) / step for i in range(TARGET_DIM)]
-    # Fallback: stride sampling without extra deps
-    stride = n / TARGET_DIM
-    return [vec[int(i*stride)] for i in range(TARGET_DIM)]
+    return prepare_vectors(vecs)
+
+
+def load_chunks(path: Path) -> List[str]:
+    # Materialize here: results are pickled back from the worker process
+    return list(chunk_text(extract_text(path)))
+
+
+def upsert_batch(vectors: List[dict]) -> None:
+    index.upsert(
+        namespace=PINECONE_NAMESPACE,
+        vectors=vectors,
+    )
+
+
+def is_rate_limited(error: Exception) -> bool:
+    # Gemini errors carry the HTTP status as .code, OpenAI's as .status_code
+    return 429 in (getattr(error, "code", None), getattr(error, "status_code", None))
+
+
+def embed_with_retry(texts: List[str]) -> List[List[float]]:
+    """embed_batch, backing off exponentially while the embedding API rate-limits us."""
+    for attempt in range(EMBED_RETRIES):
+        try:
+            return embed_batch(texts)
+        except Exception as e:
+            if attempt == EMBED_RETRIES - 1 or not is_rate_limited(e):
+                raise
+            delay = 2 ** attempt + random.random()
+            print(f"Rate limited, retrying in {delay:.1f}s")
+            time.sleep(delay)
+
+
+def to_vectors(batch: List[Tuple[str, int, str]], vecs: List[List[float]]) -> List[dict]:
+    vectors = []
+    for (name, i, chunk), vec in zip(batch, vecs):
+        rid = f"{name}#{i}-{uuid.uuid4().hex[:8]}"
+
+        url = None
+        if GITHUB_DOC_BASE_URL:
+            # simple best-effort URL (spaces remain as in example citation)
+            url = GITHUB_DOC_BASE_URL.rstrip("/") + "/" + name
+
+        metadata = {
+            "source_file": name,
+            "chunk_index": i,
+            "chunk_text": chunk,
+        }
+        if url:
+            metadata["url"] = url
+
+        vectors.append(
+            {
+                "id": rid,
+                "values": vec,
+                "metadata": metadata,
+            }
+        )
+    return vectors
+
+
+def embed_then_upsert(batch: List[Tuple[str, int, str]]) -> None:
+    vecs = embed_with_retry([chunk for _, _, chunk in batch])
+    vectors = to_vectors(batch, vecs)
+    for start in range(0, len(vectors), UPSERT_BATCH_SIZE):
+        upsert_batch(vectors[start:start + UPSERT_BATCH_SIZE])
 
 
 def ingest_directory():
     base = Path(DOCS_DIR)
     files = list(base.glob("*"))
+    dry_run = "--dry-run" in sys.argv
 
     print(f"Found {len(files)} docs in {base.resolve()}")
 
-    for fp in files:
-        if not fp.is_file():
-            continue
+    files = [fp for fp in files if fp.is_file()]
+    if not files:
+        return
+
+    # PDF parsing is CPU-bound, so extract in separate processes
+    with ProcessPoolExecutor(max_workers=min(len(files), os.cpu_count() or 1)) as pool:
+        file_chunks = list(pool.map(load_chunks, files))
 
-        text = extract_text(fp)
-        chunks = chunk_text(text)
+    # Collect chunks across all files so embeddings and upserts can be batched
+    records = []  # (file name, chunk index, chunk text)
+    for fp, chunks in zip(files, file_chunks):
         if not chunks:
             continue
 
-        vectors = []
-        for i, chunk in enumerate(chunks):
-            if "--dry-run" not in sys.argv:
-                vec = embed(chunk)
-            else:
-                vec = [0.0] * 768  # dummy vector for dry-run
-            rid = f"{fp.name}#{i}-{uuid.uuid4().hex[:8]}"
-
-            url = None
-            if GITHUB_DOC_BASE_URL:
-                # simple best-effort URL (spaces remain as in example citation)
-                url = GITHUB_DOC_BASE_URL.rstrip("/") + "/" + fp.name
-
-            metadata = {
-                "source_file": fp.name,
-                "chunk_index": i,
-                "chunk_text": chunk,
-            }
-            if url:
-                metadata["url"] = url
-
-            vectors.append(
-                {
-                    "id": rid,
-                    "values": vec,
-                    "metadata": metadata,
-                }
-            )
-
-        if "--dry-run" in sys.argv:
-            print(f"[DRY-RUN] Would ingest {len(vectors)} chunks from {fp.name}")
-        else:
-            index.upsert(
-                namespace=PINECONE_NAMESPACE,
-                vectors=vectors,
-            )
-            print(f"Ingested {len(vectors)} chunks from {fp.name}")
+        records.extend((fp.name, i, chunk) for i, chunk in enumerate(chunks))
+        if dry_run:
+            print(f"[DRY-RUN] Would ingest {len(chunks)} chunks from {fp.name}")
+
+    if dry_run or not records:
+        return
+
+    batches = [
+        records[start:start + EMBED_BATCH_SIZE]
+        for start in range(0, len(records), EMBED_BATCH_SIZE)
+    ]
+    # Embedding and upsert calls are network-bound; run them on a thread pool.
+    # Each batch is upserted as soon as it's embedded, so one failed batch
+    # doesn't throw away the others.
+    counts = Counter()
+    done = 0
+    with ThreadPoolExecutor(max_workers=INGEST_WORKERS) as executor:
+        futures = {executor.submit(embed_then_upsert, batch): batch for batch in batches}
+        for future in as_completed(futures):
+            batch = futures[future]
+            try:
+                future.result()
+            except Exception as e:
+                name, i, _ = batch[0]
+                print(f"Failed to ingest {len(batch)} chunks starting at {name}#{i}: {e}")
+                continue
+            counts.update(name for name, _, _ in batch)
+            done += len(batch)
+            print(f"Ingested {done}/{len(records)} chunks")
+
+    for name, count in counts.items():
+        print(f"Ingested {count} chunks from {name}")
+    if done < len(records):
+        raise SystemExit(f"{len(records) - done} of {len(records)} chunks failed to ingest")
 
 
 if __name__ == "__main__":
@@ -1,11 +1,22 @@
 # rag_backend.py
 import os
-from typing import List, Dict, Any
+import asyncio
+import functools
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from typing import List, Dict, Any, Optional
 
+import httpx
+import numpy as np
 from dotenv import load_dotenv
 from google import genai
-from openai import OpenAI
-from pinecone import Pinecone, ServerlessSpec
+from google.genai import types as genai_types
+from openai import AsyncOpenAI
+from pinecone import Index, Pinecone, ServerlessSpec
+from pinecone.core.client.configuration import Configuration as OpenApiConfiguration
+
+from embeddings import SENTENCE_ENDS, TARGET_DIM, prepare_vectors
 
 load_dotenv()
 
@@ -14,79 +25,250 @@ OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 PINECONE_API_KEY = os.environ["PINECONE_API_KEY"]
 PINECONE_INDEX_HOST = os.environ["PINECONE_INDEX_HOST"]
 PINECONE_NAMESPACE = os.getenv("PINECONE_NAMESPACE", "hr")
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "40"))
+
+# Keep-alive pools so repeat calls skip the TCP+TLS handshake
+HTTP_LIMITS = httpx.Limits(
+    max_connections=100,
+    max_keepalive_connections=HTTP_POOL_SIZE,
+    keepalive_expiry=60,
+)
+http_client = httpx.AsyncClient(limits=HTTP_LIMITS, http2=True, timeout=30.0)
 
-client = genai.Client(api_key=GEMINI_API_KEY)
-openai_client = OpenAI(api_key=OPENAI_API_KEY) if OPENAI_API_KEY else None
+client = genai.Client(
+    api_key=GEMINI_API_KEY,
+    http_options=genai_types.HttpOptions(httpx_async_client=http_client),
+)
+openai_client = (
+    AsyncOpenAI(api_key=OPENAI_API_KEY, http_client=http_client)
+    if OPENAI_API_KEY
+    else None
+)
 pc = Pinecone(api_key=PINECONE_API_KEY)
-index = pc.Index(host=PINECONE_INDEX_HOST)
-TARGET_DIM = int(os.getenv("EMBED_DIM", "768"))
+# Passing openapi_config to Pinecone() is deprecated (DeprecationWarning on
+# import), so the pool size is set on the data-plane Index directly.
+pinecone_config = OpenApiConfiguration.get_default_copy()
+pinecone_config.connection_pool_maxsize = HTTP_POOL_SIZE
+index = Index(api_key=PINECONE_API_KEY, host=PINECONE_INDEX_HOST, openapi_config=pinecone_config)
+# Pinecone's client is sync-only. Its calls get their own threads, sized to
+# the connection pool: the default to_thread executor is min(32, cpus + 4)
+# threads (5 on a 1-CPU box), which would leave most of the pool unused.
+pinecone_executor = ThreadPoolExecutor(max_workers=HTTP_POOL_SIZE, thread_name_prefix="pinecone")
+SEMANTIC_CACHE_SIZE = int(os.getenv("SEMANTIC_CACHE_SIZE", "1024"))
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.95"))
+SEMANTIC_CACHE_LSH_BITS = int(os.getenv("SEMANTIC_CACHE_LSH_BITS", "8"))
+SEMANTIC_CACHE_TTL = int(os.getenv("SEMANTIC_CACHE_TTL", "3600"))
 
+# Retrieval results are columnar: {"scores": [...], "texts": [...], "files": [...], "urls": [...]}
+Docs = Dict[str, List[Any]]
 
-def embed_query(text: str) -> List[float]:
-    """Embed query text using Gemini, with OpenAI fallback if quota exceeded."""
+
+class SemanticCache:
+    """Cache retrieval results by query embedding (cosine similarity).
+
+    Entries live in a fixed-size ring buffer: one float32 matrix of unit
+    vectors plus parallel lists for the cached docs. Random-projection LSH
+    buckets narrow each lookup to a handful of candidate rows; buckets one
+    bit-flip away are probed too, so near-duplicates that straddle a
+    hyperplane are still found. Entries expire ttl seconds after they were
+    stored, so a re-ingested index is picked up without a restart.
+    """
+
+    def __init__(self, dim: int, size: int, threshold: float, n_bits: int, ttl: float, seed: int = 0):
+        self.size = size
+        self.threshold = threshold
+        self.ttl = ttl
+        self.vectors = np.zeros((size, dim), dtype=np.float32)
+        self.docs: List[Optional[Docs]] = [None] * size
+        self.top_ks: List[int] = [0] * size
+        self.keys: List[Optional[int]] = [None] * size
+        self.stored_at: List[float] = [0.0] * size
+        self.buckets: Dict[int, List[int]] = {}
+        self.planes = np.random.default_rng(seed).standard_normal((n_bits, dim)).astype(np.float32)
+        self.bit_weights = 1 << np.arange(n_bits)
+        self.next_slot = 0
+        self.lock = Lock()
+
+    def _normalize(self, vec: List[float]) -> Optional[np.ndarray]:
+        arr = np.asarray(vec, dtype=np.float32)
+        norm = np.linalg.norm(arr)
+        if norm == 0:
+            return None
+        return arr / norm
+
+    def _bucket_key(self, unit: np.ndarray) -> int:
+        bits = (self.planes @ unit) > 0
+        return int(bits @ self.bit_weights)
+
+    def get(self, vec: List[float], top_k: int) -> Optional[Docs]:
+        unit = self._normalize(vec)
+        if unit is None:
+            return None
+        key = self._bucket_key(unit)
+        probe_keys = [key] + [key ^ (1 << b) for b in range(len(self.planes))]
+        fresh_after = time.monotonic() - self.ttl
+        with self.lock:
+            slots = [
+                s
+                for k in probe_keys
+                for s in self.buckets.get(k, ())
+                if self.top_ks[s] == top_k and self.stored_at[s] > fresh_after
+            ]
+            if not slots:
+                return None
+            sims = self.vectors[slots] @ unit
+            best = int(np.argmax(sims))
+            if sims[best] < self.threshold:
+                return None
+            return self.docs[slots[best]]
+
+    def put(self, vec: List[float], top_k: int, docs: Docs) -> None:
+        unit = self._normalize(vec)
+        if unit is None:
+            return
+        key = self._bucket_key(unit)
+        with self.lock:
+            slot = self.next_slot
+            self.next_slot = (slot + 1) % self.size
+            old_key = self.keys[slot]
+            if old_key is not None:
+                bucket = self.buckets[old_key]
+                bucket.remove(slot)
+                if not bucket:
+                    del self.buckets[old_key]
+            self.vectors[slot] = unit
+            self.docs[slot] = docs
+            self.top_ks[slot] = top_k
+            self.keys[slot] = key
+            self.stored_at[slot] = time.monotonic()
+            self.buckets.setdefault(key, []).append(slot)
+
+
+semantic_cache = (
+    SemanticCache(
+        TARGET_DIM,
+        SEMANTIC_CACHE_SIZE,
+        SEMANTIC_CACHE_THRESHOLD,
+        SEMANTIC_CACHE_LSH_BITS,
+        SEMANTIC_CACHE_TTL,
+    )
+    if SEMANTIC_CACHE_SIZE > 0
+    else None
+)
+
+
+async def embed_queries(texts: List[str]) -> List[List[float]]:
+    """Embed several query texts in one call using Gemini, with OpenAI fallback if quota exceeded."""
     try:
-        res = client.models.embed_content(
+        res = await client.aio.models.embed_content(
             model="gemini-embedding-001",
-            contents=text,
+            contents=texts,
         )
-        vec = res.embeddings[0].values
+        vecs = [e.values for e in res.embeddings]
     except Exception:
         # Fallback to OpenAI if Gemini fails and OpenAI is configured
         if openai_client:
-            response = openai_client.embeddings.create(
+            response = await openai_client.embeddings.create(
                 model="text-embedding-3-small",
-                input=text
+                input=texts
             )
-            vec = response.data[0].embedding
+            vecs = [d.embedding for d in response.data]
         else:
             raise
-    
-    # Ensure dimension matches target
-    n = len(vec)
-    if n == TARGET_DIM:
-        return vec
-    if n % TARGET_DIM == 0:
-        step = n // TARGET_DIM
-        return [sum(vec[i*step:(i+1)*step]) / step for i in range(TARGET_DIM)]
-    stride = n / TARGET_DIM
-    return [vec[int(i*stride)] for i in range(TARGET_DIM)]
-
-
-def get_hr_policy(query: str, top_k: int = 5) -> List[Dict[str, Any]]:
-    """This function is your 'get_hr_policy' tool from the course."""
-    vec = embed_query(query)
-    result = index.query(
-        namespace=PINECONE_NAMESPACE,
-        vector=vec,
-        top_k=top_k,
-        include_metadata=True,
-        include_values=False,
+    return prepare_vectors(vecs)
+
+
+async def embed_query(text: str) -> List[float]:
+    """Embed query text using Gemini, with OpenAI fallback if quota exceeded."""
+    return (await embed_queries([text]))[0]
+
+
+async def query_index(vec: List[float], top_k: int) -> Docs:
+    """Fetch the top_k matches for an embedded query, via the semantic cache."""
+    if semantic_cache:
+        cached = semantic_cache.get(vec, top_k)
+        if cached is not None:
+            return cached
+
+    # Keep the blocking call off the event loop
+    result = await asyncio.get_running_loop().run_in_executor(
+        pinecone_executor,
+        functools.partial(
+            index.query,
+            namespace=PINECONE_NAMESPACE,
+            vector=vec,
+            top_k=top_k,
+            include_metadata=True,
+            include_values=False,
+        ),
     )
 
-    docs = []
-    for m in result["matches"]:
-        md = m.get("metadata", {})
-        docs.append(
-            {
-                "score": m.get("score"),
-                "text": md.get("chunk_text", ""),
-                "file": md.get("source_file", ""),
-                "url": md.get("url"),
-            }
-        )
+    matches = result["matches"]
+    metadata = [m.get("metadata", {}) for m in matches]
+    docs = {
+        "scores": [m.get("score") for m in matches],
+        "texts": [md.get("chunk_text", "") for md in metadata],
+        "files": [md.get("source_file", "") for md in metadata],
+        "urls": [md.get("url") for md in metadata],
+    }
+    if semantic_cache:
+        semantic_cache.put(vec, top_k, docs)
     return docs
 
 
-def build_sources_markdown(docs: List[Dict[str, Any]]) -> str:
+async def get_hr_policy(query: str, top_k: int = 5) -> Docs:
+    """This function is your 'get_hr_policy' tool from the course."""
+    vec = await embed_query(query)
+    return await query_index(vec, top_k)
+
+
+async def get_hr_policy_batch(queries: List[str], top_k: int = 5) -> List[Docs]:
+    """get_hr_policy for several queries, sharing a single embedding call."""
+    vecs = await embed_queries(queries)
+    return await asyncio.gather(*(query_index(vec, top_k) for vec in vecs))
+
+
+def trim_to_boundary(text: str, max_chars: int) -> str:
+    """Cut text to max_chars, preferring a sentence end, then a word break."""
+    if len(text) <= max_chars:
+        return text
+    floor = max_chars // 2
+    cut = max(text.rfind(sep, floor, max_chars) for sep in SENTENCE_ENDS)
+    if cut != -1:
+        return text[:cut + 1].rstrip()
+    cut = text.rfind(" ", floor, max_chars)
+    return text[:cut if cut != -1 else max_chars]
+
+
+def build_context(docs: Docs, max_chars: int = 2000) -> str:
+    """Join snippets as a bulleted list without exceeding max_chars.
+
+    The budget is split evenly across docs; whatever a short snippet leaves
+    unused carries over to the ones after it, so every doc contributes.
+    """
+    texts = docs["texts"]
+    parts = []
+    remaining = max_chars
+    for i, text in enumerate(texts):
+        # 4 = "- " prefix plus the "\n\n" separator
+        share = remaining // (len(texts) - i) - 4
+        if share <= 0:
+            break
+        text = trim_to_boundary(text, share)
+        parts.append(f"- {text}")
+        remaining -= len(text) + 4
+    return "\n\n".join(parts)
+
+
+def build_sources_markdown(docs: Docs) -> str:
     """Format like the example in system_prompt.txt."""
     lines = ["Sources:"]
     # make each file appear only once
-    seen = {}
-    for d in docs:
-        file = d["file"] or "Document"
+    seen = set()
+    for file, url in zip(docs["files"], docs["urls"]):
+        file = file or "Document"
         if file in seen:
             continue
-        seen[file] = True
-        url = d.get("url") or file
-        lines.append(f"- ^1 [{file}]({url})")
+        seen.add(file)
+        lines.append(f"- ^1 [{file}]({url or file})")
     return "\n".join(lines)